@@ -9,19 +9,53 @@ Designed for Python 3.6.8 compatibility. Only standard libs are used.
 
 from sys        import exit, argv
 from getopt     import getopt, GetoptError
+from os         import open as os_open, close as os_close, devnull, environ, O_WRONLY
 from os.path    import isfile
-from contextlib import closing
-from threading  import Thread, local
+from threading  import Barrier, BrokenBarrierError, Event
 from time       import sleep
-from json       import loads as json_loads
-from datetime   import datetime, timedelta, MINYEAR, MAXYEAR
-from subprocess import run as subprocess_run
-from subprocess import DEVNULL
+from functools  import lru_cache
+from datetime   import timedelta
+try:
+    from time import perf_counter_ns
+except ImportError: # Python 3.6 has no perf_counter_ns
+    from time import perf_counter
+    def perf_counter_ns():
+        return int(perf_counter() * 1000000000)
+try:
+    from os import posix_spawn, waitpid, POSIX_SPAWN_DUP2
+    from os import WIFSIGNALED, WTERMSIG, WEXITSTATUS
+    from signal import SIGPIPE, SIGXFSZ
+except ImportError: # Python < 3.8 or non-POSIX platform
+    posix_spawn = None
 
 _DEFAULT_RUNS  = 8
 _DEFAULT_PAUSE = 5
 
-help_text = '''
+# Command line options and JSON keys (upper case) to SPscript attributes
+_OPT_MAP = {
+    '-c' : 'command',  'COMMAND'  : 'command',
+    '-n' : 'runs',     'TIMES'    : 'runs',
+    '-w' : 'pause',    'SECONDS'  : 'pause',
+    '-p' : 'mode_prl', 'PARALLEL' : 'mode_prl',
+    '-s' : 'mode_sh',  'SHELL'    : 'mode_sh',
+    '-h' : 'help',     '--help'   : 'help'
+}
+
+def popen_wait(args, kwargs):
+    """Run command via subprocess.Popen and return its exit code."""
+    popen, cmd_line = args
+    return popen(cmd_line, **kwargs).wait()
+
+def spawn_wait(args, kwargs):
+    """Run command via os.posix_spawn and return exit code the way Popen does."""
+    status = waitpid(posix_spawn(*args, **kwargs), 0)[1]
+    return -WTERMSIG(status) if WIFSIGNALED(status) else WEXITSTATUS(status)
+
+def ns_to_timedelta(ns):
+    """Convert nanoseconds to timedelta for display."""
+    return timedelta(microseconds=ns / 1000)
+
+_HELP_TEMPLATE = '''
 Run console command and measure its execution time.
 Usage:
     python3 sptest.py [<parameters> | <filename>]
@@ -31,6 +65,12 @@ Parameters can be provided using command line or JSON file. JSON is a priority.
 Parameters:
     -c COMMAND : command to execute, mandatory parameter;
                  JSON key name - COMMAND
+    -s         : run command via system shell, required for pipes,
+                 redirections, shell built-ins, scripts without shebang line
+                 etc., by default command is split into arguments and
+                 executed directly;
+                 JSON key name - SHELL, presence of this key in JSON file
+                 turns shell mode on, value of this key is ignored
     -p         : run commands in parallel, by default commands are executed
                  sequentially;
                  JSON key name - PARALLEL, presence of this key in JSON file
@@ -38,9 +78,9 @@ Parameters:
     -n TIMES   : number of parallel copies in parallel mode or number of
                  repeated runs in sequential mode, {def_runs} by default;
                  JSON key name - TIMES
-    -w SECONDS : pause in seconds - between commands start in parallel mode or
-                 between each command run in sequential mode, {def_pause} by
-                 default;
+    -w SECONDS : pause in seconds between commands start, {def_pause} by default;
+                 in sequential mode next command starts right after previous
+                 one if it runs longer than the pause;
                  JSON key name - SECONDS
     -h, --help : display usage info, not used in JSON
 
@@ -48,11 +88,12 @@ All parameters but -c (COMMAND) are optional. If JSON file is provided and decod
 successfully, parameters from JSON are used and command line parameters are
 ignored. Overwise command line parameters are used.
 
-Attention! The validity of COMMAND is not checked. Be careful not to run
-invalid command multiple times!
+Attention! The validity of COMMAND is not checked, without -s only presence of
+its executable is. Be careful not to run invalid command multiple times!
 
 Examples of usage:
     python3 sptest.py -p -c 'ls -la' -n 5
+    python3 sptest.py -s -c 'ls -la | wc -l' -w 1
     ./sptest.py test.json
 
 JSON example:
@@ -61,49 +102,56 @@ JSON example:
     "SECONDS": 1,
     "PARALLEL": "any_value"
 {cl}
-'''.format(
-    def_runs  = _DEFAULT_RUNS,
-    def_pause = _DEFAULT_PAUSE,
-    op = '{', cl = '}' # Dumb params to insert curly brackets into f-string
-)
+'''
+
+@lru_cache(maxsize=1)
+def help_text():
+    """Format usage info on first request only, it is not needed on normal runs."""
+    return _HELP_TEMPLATE.format(
+        def_runs  = _DEFAULT_RUNS,
+        def_pause = _DEFAULT_PAUSE,
+        op = '{', cl = '}' # Dumb params to insert curly brackets into f-string
+    )
 
 class SPscript:
 
     def __init__(self, cmdl_params):
 
         self.mode_prl = False
+        self.mode_sh  = False
         self.command  = ""
         self.runs     = _DEFAULT_RUNS
         self.pause    = _DEFAULT_PAUSE
 
         try:
-            opts, args = getopt(cmdl_params, "c:n:w:ph", ["help"])
+            opts, args = getopt(cmdl_params, "c:n:w:psh", ["help"])
             if not opts and not args:
                 self.no_command()
             if args: # JSON filename provided
+                from json import load as json_load # not needed for CLI parameters
                 filename = args[0]
                 if not isfile(filename):
                     print("File '{}' not found.".format(filename))
                     exit(2)
                 try:
-                    with closing(open(filename, 'r')) as file:
-                        json_text = file.read()
-                except Exception as err:
-                    print("Error while reading file '{}':".format(filename), err, sep='\n')
+                    with open(filename, 'r') as file:
+                        json_data = json_load(file)
+                except ValueError as err: # JSONDecodeError or bad encoding
+                    print("Error while parsing JSON data from file '{}':".format(filename), err, sep='\n')
                     exit(2)
-                try:
-                    json_data = json_loads(json_text)
                 except Exception as err:
-                    print("Error while parsing JSON data from file '{}':".format(filename), json_text, err, sep='\n')
+                    print("Error while reading file '{}':".format(filename), err, sep='\n')
                     exit(2)
-                opts = list(json_data.items())
+                opts = json_data.items()
             for opt, value in opts:
-                if   opt == '-c' or opt.upper() == 'COMMAND'  : self.command  = value
-                elif opt == '-n' or opt.upper() == 'TIMES'    : self.runs     = int(value)
-                elif opt == '-w' or opt.upper() == 'SECONDS'  : self.pause    = int(value)
-                elif opt == '-p' or opt.upper() == 'PARALLEL' : self.mode_prl = True
-                elif opt in ('-h', '--help'):
-                    print(help_text)
+                attr = _OPT_MAP.get(opt) or _OPT_MAP.get(opt.upper())
+                if   attr == 'command'  : self.command  = value
+                elif attr == 'runs'     : self.runs     = int(value)
+                elif attr == 'pause'    : self.pause    = int(value)
+                elif attr == 'mode_prl' : self.mode_prl = True
+                elif attr == 'mode_sh'  : self.mode_sh  = True
+                elif attr == 'help':
+                    print(help_text())
                     exit(0)
                 if self.runs < 1 or self.pause < 0:
                     raise ValueError
@@ -111,40 +159,96 @@ class SPscript:
             print("Values of -n (TIMES) and/or -w (SECONDS) parameters do not look like suitable integers.", err, sep='\n')
             exit(2)
         except GetoptError as err:
-            print(err, help_text, sep='\n')
+            print(err, help_text(), sep='\n')
             exit(2)
         if not self.command:
             self.no_command()
-        
-        TIME_NONE = datetime(year=MINYEAR, month=1, day=1)
-        self.timings = [
-            {
-                'e_code' : 0,
-                'start'  : TIME_NONE,
-                'finish' : TIME_NONE,
-                'time'   : timedelta()
-            }
-            for i in range(self.runs)
-        ]
+        if self.mode_sh:
+            self.cmd_line = self.command
+            executable = '/bin/sh'
+        else: # Split once here to skip extra shell process on each run
+            from shlex  import split as shlex_split
+            from shutil import which
+            try:
+                self.cmd_line = shlex_split(self.command)
+            except ValueError as err:
+                print("Command '{}' can not be split into arguments.".format(self.command), err, sep='\n')
+                exit(2)
+            if not self.cmd_line:
+                self.no_command()
+            executable = which(self.cmd_line[0])
+            if not executable:
+                print("Executable '{}' not found. Use -s (SHELL) parameter for shell built-ins.".format(self.cmd_line[0]))
+                exit(2)
+
+        self.executable = executable
+
+        # Timings are stored in nanoseconds as parallel lists indexed by iteration
+        self.e_codes  = [0] * self.runs
+        self.starts   = [0] * self.runs
+        self.finishes = [0] * self.runs
+        self.times_ns = [0] * self.runs
+
+    def prepare_launch(self):
+        """Set up launcher for execute(), return /dev/null descriptor to close after runs."""
+        # Invariant launch arguments, /dev/null is opened once for all runs.
+        # Output goes to /dev/null to prevent memory overrun in case of huge
+        # output and to stop console output completely.
+        null_fd = os_open(devnull, O_WRONLY)
+        if posix_spawn: # Python 3.8+ on POSIX, avoids fork() page table copying
+            self.launch = spawn_wait
+            self.launch_args = (
+                self.executable,
+                ['sh', '-c', self.command] if self.mode_sh else self.cmd_line,
+                environ
+            )
+            self.launch_kwargs = dict(
+                file_actions=[
+                    (POSIX_SPAWN_DUP2, null_fd, 1),
+                    (POSIX_SPAWN_DUP2, null_fd, 2)
+                ],
+                # Python ignores these, restore defaults as Popen does
+                setsigdef=(SIGPIPE, SIGXFSZ)
+            )
+        else:
+            from subprocess import Popen # fallback only, skipped on Python 3.8+ POSIX
+            self.launch = popen_wait
+            self.launch_args = (Popen, self.cmd_line)
+            self.launch_kwargs = dict(
+                shell=self.mode_sh,
+                stdout=null_fd,
+                stderr=null_fd
+            )
+        return null_fd
 
     def no_command(self):
-        print("Command to run is not provided, see help below.", help_text, sep='\n')
+        print("Command to run is not provided, see help below.", help_text(), sep='\n')
         exit(2)
 
     def run_command(self, iteration):
-        data = local()
-        data.start = datetime.now()
-        data.cmd_result = subprocess_run(
-            self.command,
-            shell=True,
-            stdout=DEVNULL, # to prevent memory overrun in case of huge output
-            stderr=DEVNULL  # to stop console output completely
-        )
-        data.finish = datetime.now()
-        self.timings[iteration]['e_code'] = data.cmd_result.returncode
-        self.timings[iteration]['start']  = data.start
-        self.timings[iteration]['finish'] = data.finish
-        self.timings[iteration]['time']   = data.finish - data.start
+        # Attribute lookups are done before the clock starts
+        launch, args, kwargs = self.launch, self.launch_args, self.launch_kwargs
+        start = perf_counter_ns()
+        e_code = launch(args, kwargs)
+        finish = perf_counter_ns()
+        self.e_codes[iteration]  = e_code
+        self.starts[iteration]   = start
+        self.finishes[iteration] = finish
+        self.times_ns[iteration] = finish - start
+
+    def mark_release(self):
+        self.release_ns = perf_counter_ns() # called once by the barrier, base for start slots
+
+    def run_parallel(self, iteration, barrier, cancel):
+        try:
+            barrier.wait() # all workers are released at the same moment
+        except BrokenBarrierError: # not all workers could be started, do not run
+            return
+        # Then each one waits for its own start slot, unless run is cancelled
+        remaining = self.release_ns + iteration * self.pause * 1000000000 - perf_counter_ns()
+        if cancel.wait(max(remaining, 0) / 1000000000):
+            return
+        self.run_command(iteration)
 
     def execute(self):
 
@@ -154,52 +258,78 @@ class SPscript:
             p   = self.pause
         ), end=' ')
 
-        if self.mode_prl:
-            print("in parallel mode:")
-            threads = [
-                Thread(target=self.run_command, args=(i,))
-                for i in range(self.runs)
-            ]
-        else:
-            print("in sequential mode:")
-        for i in range(self.runs):
-            print("starting iteration {}...".format(i + 1), end=' ', flush=True)
+        pause_ns = self.pause * 1000000000
+        null_fd = self.prepare_launch()
+        try:
             if self.mode_prl:
-                threads[i].start()
-                print("started")
+                print("in parallel mode:")
+                from concurrent.futures import ThreadPoolExecutor # not needed in sequential mode
+                # Printed once before threads are submitted, keeps stdout off their start path
+                print("Waiting for {} threads to finish...".format(self.runs), end=' ', flush=True)
+                barrier = Barrier(self.runs, action=self.mark_release)
+                cancel  = Event()
+                # Pool must hold all workers at once, otherwise barrier never breaks
+                with ThreadPoolExecutor(max_workers=self.runs) as pool:
+                    try:
+                        futures = [
+                            pool.submit(self.run_parallel, i, barrier, cancel)
+                            for i in range(self.runs)
+                        ]
+                        for future in futures: future.result() # re-raises worker errors
+                    except BaseException: # Ctrl-C, worker error or thread start failure
+                        cancel.set()    # workers waiting for their start slot skip the run
+                        barrier.abort() # workers not released yet skip it too
+                        raise
+                print("done")
+                # Deviation of actual starts from the iteration * pause schedule
+                first_start = min(self.starts)
+                offset_errors = [
+                    abs(start - first_start - i * pause_ns)
+                    for i, start in enumerate(self.starts)
+                ]
+                print("Started {} threads, start offset error: max {}, mean {}".format(
+                    self.runs,
+                    ns_to_timedelta(max(offset_errors)),
+                    ns_to_timedelta(sum(offset_errors) // self.runs)
+                ))
             else:
-                self.run_command(i)
-                print("done in", self.timings[i]['time'])
-            if i + 1 < self.runs: # No need for sleep on last iteration
-                sleep(self.pause)
-        if self.mode_prl:
-            print("Waiting for threads to finish...", end=' ', flush=True)
-            for th in threads: th.join()
-            print("done")
+                print("in sequential mode:")
+                schedule = perf_counter_ns() # fixed baseline, so sleep errors do not accumulate
+                for i in range(self.runs):
+                    self.run_command(i)
+                    # Single unflushed line per iteration, no extra writes around the run
+                    print("iteration {} done in".format(i + 1), ns_to_timedelta(self.times_ns[i]))
+                    if i + 1 < self.runs: # No need for sleep on last iteration
+                        schedule += pause_ns # next start, command time included
+                        remaining = schedule - perf_counter_ns()
+                        if remaining > 0:
+                            sleep(remaining / 1000000000)
+                        else: # command was longer than pause, no catching up
+                            schedule -= remaining
+        except OSError as err: # e.g. script without shebang line in direct mode
+            print("\nError while launching command '{}':".format(self.command), err, sep='\n')
+            if not self.mode_sh:
+                print("Use -s (SHELL) parameter to run it via shell.")
+            exit(2)
+        finally:
+            os_close(null_fd)
 
         # Results processing
-        min_start  = datetime(year=MAXYEAR, month=12, day=31)
-        max_finish = datetime(year=MINYEAR, month=1,  day=1)
-        sum_time   = timedelta()
-        min_time   = timedelta.max
-        max_time   = timedelta.min
-        error_cnt  = 0
-        for timing in self.timings:
-            if timing['e_code'] != 0         : error_cnt += 1
-            if timing['start']  < min_start  : min_start  = timing['start']
-            if timing['finish'] > max_finish : max_finish = timing['finish']
-            if timing['time']   < min_time   : min_time   = timing['time']
-            if timing['time']   > max_time   : max_time   = timing['time']
-            sum_time += timing['time']
+        min_start  = min(self.starts)
+        max_finish = max(self.finishes)
+        sum_time   = sum(self.times_ns)
+        min_time   = min(self.times_ns)
+        max_time   = max(self.times_ns)
+        error_cnt  = sum(1 for e_code in self.e_codes if e_code)
         total_time = max_finish - min_start
-        print("Total time spent ...........", total_time)
-        print("Fastest iteration ..........", min_time)
-        print("Slowest iteration ..........", max_time)
-        print("Average iteration ..........", sum_time / float(self.runs))
-        times = sorted(list(map(lambda t: t['time'], self.timings)))
+        print("Total time spent ...........", ns_to_timedelta(total_time))
+        print("Fastest iteration ..........", ns_to_timedelta(min_time))
+        print("Slowest iteration ..........", ns_to_timedelta(max_time))
+        print("Average iteration ..........", ns_to_timedelta(sum_time // self.runs))
+        times = sorted(self.times_ns)
         mid_pos = self.runs // 2
         # Hocus-pocus with ~ operator for median calculation
-        print("Median iteration ...........", (times[mid_pos] + times[~mid_pos]) * 0.5)
+        print("Median iteration ...........", ns_to_timedelta((times[mid_pos] + times[~mid_pos]) >> 1))
         if error_cnt:
             print("Attention! {} iteration(s) finished with non-zero exit code!".format(error_cnt))
 